@@ -4,14 +4,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import datetime as dt
-from scipy.spatial import distance as dist
 from pinpoint import TagDictionary as TagList
 import glob
 import os
+import math
 import pickle
+import threading
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+from numba import njit
 #%matplotlib inline
 ##get_ipython().magic(u'matplotlib inline')
-##cv2.setNumThreads(0) # Turn off multithreading to prevent errors
 ##print "packages loaded"
 
 
@@ -20,81 +25,110 @@ import pickle
 # In[ ]:
 
 
-##def undistort_image(image, calib_params, crop = True):
-##
-##	""" Returns undistorted image using calibration parameters.
-##
-##		Parameters
-##		----------
-##		image : numpy_array 
-##			Image to be undistorted
-##		calib_params : dict
-##			Calibration parameters from calibrate_camera()
-##		crop : bool
-##			Crop the image to the optimal region of interest
-##			
-##		Returns
-##		-------
-##		dst : numpy_array
-##			Undistorted image.
-##
-##	"""
-##	try:
-##		ret = calib_params["ret"]
-##		mtx = calib_params["mtx"]
-##		dist = calib_params["dist"]
-##		rvecs = calib_params["rvecs"]
-##		tvecs = calib_params["tvecs"]
-##	except:
-##		raise TypeError("calib_params must be 'dict'")
-##
-##	img = image
-##	h,  w = img.shape[:2]
-##	newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
-##
-##	# undistort
-##	mapx, mapy = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, (w,h), 5)
-##	dst = cv2.remap(img, mapx, mapy, cv2.INTER_LINEAR)
-##
-##
-##	# crop the image
-##	if crop:
-##		x,y,w,h = roi
-##		dst = dst[y:y+h, x:x+w]
-##
-##	return dst
-##
-##def load_calib(filename):
-##	""" Loads calibration parameters from '.pkl' file.
-##
-##		Parameters
-##		----------
-##		filename : str8
-##			Path to load file, must be '.pkl' extension
-##			
-##		Returns
-##		-------
-##		calib_params : dict
-##			Parameters for undistorting images.
-##
-##	"""
-##	# read python dict back from the file
-##	
-##	pkl_file = open(filename, 'rb')
-##
-##	try:
-##		calib_params = pickle.load(pkl_file)
-##	except:
-##		raise IOError("File must be '.pkl' extension")
-##
-##	pkl_file.close()
-##
-##	return calib_params
-##
-##
-### ## Define function for adding border back to barcodes
-##
-### In[ ]:
+_undistort_maps = {} # cache of undistortion maps keyed by calibration contents and (w,h)
+
+def build_undistort_maps(calib_params, size):
+
+	""" Returns fixed-point undistortion maps for a given frame size.
+
+		The maps only depend on the camera intrinsics and the frame size, so
+		they are computed once and cached instead of being rebuilt for every frame.
+
+		Parameters
+		----------
+		calib_params : dict
+			Calibration parameters from calibrate_camera()
+		size : tuple of int
+			Frame size as (width, height)
+			
+		Returns
+		-------
+		map1, map2 : numpy_array
+			Fixed-point (CV_16SC2) maps for cv2.remap()
+		roi : tuple of int
+			Optimal region of interest as (x, y, w, h)
+
+	"""
+	try:
+		mtx = np.asarray(calib_params["mtx"], np.float64)
+		dist = np.asarray(calib_params["dist"], np.float64)
+	except:
+		raise TypeError("calib_params must be 'dict'")
+
+	# key on the calibration values, so reloading the same calibration reuses
+	# its maps and a new calibration can never get another one's maps
+	key = (mtx.tobytes(), dist.tobytes(), tuple(size))
+	if key in _undistort_maps:
+		return _undistort_maps[key]
+
+	w, h = size
+	newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
+	mapx, mapy = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, (w,h), cv2.CV_32FC1)
+
+	# fixed-point maps halve the memory traffic of cv2.remap()
+	map1, map2 = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+
+	_undistort_maps[key] = (map1, map2, roi)
+
+	return map1, map2, roi
+
+def undistort_image(image, calib_params, crop = True):
+
+	""" Returns undistorted image using calibration parameters.
+
+		Parameters
+		----------
+		image : numpy_array 
+			Image to be undistorted
+		calib_params : dict
+			Calibration parameters from calibrate_camera()
+		crop : bool
+			Crop the image to the optimal region of interest
+			
+		Returns
+		-------
+		dst : numpy_array
+			Undistorted image.
+
+	"""
+	img = image
+	h,  w = img.shape[:2]
+	map1, map2, roi = build_undistort_maps(calib_params, (w,h))
+
+	# undistort
+	dst = cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+	# crop the image
+	if crop:
+		x,y,w,h = roi
+		dst = dst[y:y+h, x:x+w]
+
+	return dst
+
+def load_calib(filename):
+	""" Loads calibration parameters from '.pkl' file.
+
+		Parameters
+		----------
+		filename : str8
+			Path to load file, must be '.pkl' extension
+			
+		Returns
+		-------
+		calib_params : dict
+			Parameters for undistorting images.
+
+	"""
+	# read python dict back from the file
+	with open(filename, 'rb') as pkl_file:
+		calib_params = pickle.load(pkl_file)
+
+	return calib_params
+
+
+# ## Define function for adding border back to barcodes
+
+# In[ ]:
 
 
 def add_border(tag, tag_shape, white_width = 1, black_width = 2):
@@ -145,83 +179,164 @@ def distance(vector):
  
     """ Return distance of vector """
 
-    return np.sqrt(np.sum(np.square(vector)))
+    return math.hypot(vector[0], vector[1])
 
 def order_points(pts):
-    # sort the points based on their x-coordinates
-    sorted_ = pts[np.argsort(pts[:, 0]), :]
- 
-    # grab the left-most and right-most points from the sorted
-    # x-roodinate points
-    left = sorted_[:2, :]
-    right = sorted_[2:, :]
- 
-    # now, sort the left-most coordinates according to their
-    # y-coordinates so we can grab the top-left and bottom-left
-    # points, respectively
-    left = left[np.argsort(left[:, 1]), :]
-    (tl, bl) = left
- 
-    # now that we have the top-left coordinate, use it as an
-    # anchor to calculate the Euclidean distance between the
-    # top-left and right-most points; by the Pythagorean
-    # theorem, the point with the largest distance will be
-    # our bottom-right point
-    D = dist.cdist(tl[np.newaxis], right, "euclidean")[0]
-    (br, tr) = right[np.argsort(D)[::-1], :]
-    
+    # the top-left point has the smallest x + y sum and the
+    # bottom-right point has the largest
+    s = pts[:, 0] + pts[:, 1]
+
+    # the top-right point has the largest x - y difference and
+    # the bottom-left point has the smallest
+    d = pts[:, 0] - pts[:, 1]
+
+    idx = [np.argmin(s), np.argmax(d), np.argmax(s), np.argmin(d)]
+
+    # near 45 degrees of rotation the sums or differences tie and the same
+    # corner can be picked twice, so fall back to sorting the corners by
+    # their angle around the centroid (clockwise in image coordinates)
+    if len(set(idx)) < 4:
+        centre = pts.mean(0)
+        idx = np.argsort(np.arctan2(pts[:, 1] - centre[1], pts[:, 0] - centre[0]))
+
     # return the coordinates in top-left, top-right,
     # bottom-right, and bottom-left order
-    return np.array([tl, tr, br, bl], dtype="float32")
+    return np.array(pts[idx], dtype="float32")
 
-def corr2_coeff(A,B):
-    # Rowwise mean of input arrays & subtract from input arrays themeselves
-    A_mA = np.subtract(A, A.mean(1)[:,None])
-    B_mB = np.subtract(B, B.mean(1)[:,None])
+def corr_batch(W, B_unit):
 
-    # Sum of squares across rows
-    ssA = np.square(A_mA).sum(1)
-    ssB = np.square(B_mB).sum(1)
+    """ Returns the correlation of a stack of flattened tags with every barcode.
+
+        Parameters
+        ----------
+        W : (Kxflat_len) array_like
+            Flattened tag images, one per row.
+        B_unit : (Nxflat_len) numpy array
+            Barcodes with their row means subtracted and rows scaled to unit norm.
+
+        Returns
+        -------
+        correlation : (NxK) numpy array
+            Correlation coefficient between each barcode and each tag.
+    """
+
+    W = np.array(W, dtype = np.float32)
+    W -= W.mean(1, keepdims = True)
+    W /= np.sqrt(np.square(W).sum(1, keepdims = True))
+
+    return np.dot(B_unit, W.T)
+
+_popcount = np.array([bin(i).count('1') for i in range(256)], np.uint8) # set bits in each byte value
+
+def hash_tags(bits):
+
+    """ Packs each row of up to 64 binary pixels into a single uint64 hash.
+
+        Parameters
+        ----------
+        bits : (Kxflat_len) array_like of bool
+            Binarized flattened tags, one per row.
+
+        Returns
+        -------
+        hashes : (K,) numpy array of uint64
+            One hash per row.
+    """
+
+    packed = np.packbits(bits, axis = 1)
+    padded = np.zeros((packed.shape[0], 8), np.uint8)
+    padded[:, :packed.shape[1]] = packed
+
+    return padded.view(np.uint64).ravel()
+
+def match_tags(W, B_unit, B_hash, k = 8, min_value = 0.8):
+
+    """ Returns the best matching barcode and its correlation for each tag.
+
+        Barcodes are first ranked by the Hamming distance between their hash and
+        the hash of the binarized tag, and only the k closest are correlated.
+        Tags whose best pruned correlation is not above min_value are correlated
+        with every barcode, so no match is lost to the pruning.
+
+        Parameters
+        ----------
+        W : (Kxflat_len) array_like
+            Flattened tag images, one per row.
+        B_unit : (Nxflat_len) numpy array
+            Barcodes with their row means subtracted and rows scaled to unit norm.
+        B_hash : (N,) numpy array of uint64
+            hash_tags() of the binarized barcodes.
+        k : int, default = 8
+            Number of candidate barcodes correlated with each tag.
+        min_value : float, default = 0.8
+            Correlation a match must exceed to be accepted.
 
-    # Finally get corr coeff
-    return np.divide(np.dot(A_mA,B_mB.T), np.sqrt(np.dot(ssA[:,None],ssB[None])))
+        Returns
+        -------
+        best_indices : (K,) numpy array
+            Index of the best matching barcode for each tag.
+        best_values : (K,) numpy array
+            Correlation coefficient of the best match.
+    """
+
+    if B_unit.shape[0] <= k:
+        correlation = corr_batch(W, B_unit)
+        return correlation.argmax(0), correlation.max(0)
+
+    W = np.array(W, dtype = np.float32)
+    W -= W.mean(1, keepdims = True)
+
+    # Hamming distance from each tag to each barcode
+    W_hash = hash_tags(W > 0)
+    xor = (W_hash[:,None] ^ B_hash[None,:]).view(np.uint8)
+    hamming = _popcount[xor].reshape((len(W_hash), len(B_hash), 8)).sum(2)
+    topk = np.argpartition(hamming, k, axis = 1)[:, :k]
+
+    W /= np.sqrt(np.square(W).sum(1, keepdims = True))
+    correlation = np.einsum('ijd,id->ij', B_unit[topk], W)
+
+    best = correlation.argmax(1)
+    rows = np.arange(len(W))
+    best_indices = topk[rows, best]
+    best_values = correlation[rows, best]
+
+    # fall back to the full correlation for the few tags the pruning rejects
+    weak = np.flatnonzero(best_values <= min_value)
+    if len(weak) > 0:
+        correlation = np.dot(B_unit, W[weak].T)
+        best_indices[weak] = correlation.argmax(0)
+        best_values[weak] = correlation.max(0)
+
+    return best_indices, best_values
 
 def unit_vector(vector):
 	
 	""" Returns the unit vector of the vector.  """
 	
-	return np.divide(vector, np.linalg.norm(vector))
+	norm = math.hypot(vector[0], vector[1])
+	return (vector[0]/norm, vector[1]/norm)
 
 def angle(vector, degrees = True):
 	
-	"""Returns the angle between vectors 'v1' and 'v2'.
+	"""Returns the angle of 'vector' counter-clockwise from the x-axis.
 		
 		Parameters
 		----------
-		v1 : 1-D array_like
-			N-dimensional vector.
-		v2 : 1-D array_like
-			N-dimensional vector.
+		vector : 1-D array_like
+			2-dimensional vector.
 		degrees : bool, default = True
 			Return angle in degrees.
 			
 		Returns
 		-------
 		angle : float
-			Angle between v1 and v2.
+			Angle of vector in [0, 360) degrees or [0, 2*pi) radians.
 		
 		"""
 	
-	#v1_u = unit_vector(v1)
-	#v2_u = unit_vector(v2)
-	angle = np.arctan2(vector[1], vector[0]) % (2*np.pi)
-	if np.isnan(angle):
-		if (v1_u == v2_u).all():
-			return 0.0
-		else:
-			return np.pi
+	angle = math.atan2(vector[1], vector[0]) % (2*math.pi)
 	if degrees == True:
-		angle = np.degrees(angle)
+		angle = math.degrees(angle)
 	return angle
 
 def get_grayscale(color_image, channel = None):
@@ -242,6 +357,7 @@ def get_grayscale(color_image, channel = None):
 		-------
 		gray_image : (MxNx1) numpy array
 			Single-channel grayscale image as a numpy array.
+			For 'blue', 'green', and 'red' this is a strided view into color_image, not a copy.
 
 	"""
 	assert channel in ['blue', 'green', 'red', 'none', None], "channel must be 'blue', 'green', 'red', 'none', or None"
@@ -252,18 +368,14 @@ def get_grayscale(color_image, channel = None):
 	assert color_image.shape[2] == 3, "image must have 3 color channels"
 	assert color_image.dtype == np.uint8, "image array must be dtype np.uint8"
 
-	if channel == 'blue':
-		gray_image, _, _ = cv2.split(color_image)
-	if channel == 'green':
-			_, gray_image, _ = cv2.split(color_image)
-	if channel == 'red':
-		_, _, gray_image = cv2.split(color_image)
+	if channel in ['blue', 'green', 'red']:
+		gray_image = color_image[:,:,{'blue':0, 'green':1, 'red':2}[channel]]
 	if channel == None or channel == 'none':
 		gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
 
 	return gray_image
 
-def get_threshold(gray_image, block_size = 1001, offset = 2):
+def get_threshold(gray_image, block_size = 1001, offset = 2, dst = None):
 
 	""" Returns binarized thresholded image from single-channel grayscale image.
 
@@ -276,6 +388,8 @@ def get_threshold(gray_image, block_size = 1001, offset = 2):
 		offset : default = 2
 			Constant subtracted from the mean. Normally, it is positive but may be zero or negative as well. 
 			The threshold value T(x,y) is a mean of the block_size x block_size neighborhood of (x, y) minus offset.
+		dst : (MxNx1) numpy array, default = None
+			Optional preallocated output image with the same shape as gray_image.
 
 		Returns
 		-------
@@ -290,7 +404,7 @@ def get_threshold(gray_image, block_size = 1001, offset = 2):
 	assert len(gray_image.shape) == 2, "image must be grayscale"
 	assert gray_image.dtype == np.uint8, "image array must be dtype np.uint8"
 
-	threshold_image = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, offset)
+	threshold_image = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, offset, dst = dst)
 	
 
 
@@ -315,14 +429,169 @@ def get_contours(threshold_image):
 	
 	assert len(set([0, 255]) - set(np.unique(threshold_image))) == 0, "image must be binarized to (0, 255)"
 
-	_, contours, _ = cv2.findContours(threshold_image.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+	# OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 returns (contours, hierarchy)
+	contours = cv2.findContours(threshold_image.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
 
 	return contours
 
+@njit(cache = True)
+def prefilter(cnt_flat, offsets, w, h, edge_thresh, min_area = 10.0, max_area = 2000.0):
+
+	""" Returns the contours that could be tags based on their size and position.
+
+		Parameters
+		----------
+		cnt_flat : (Px2) numpy array
+			Points of all contours concatenated together.
+		offsets : 1-D numpy array
+			Index of the first point of each contour in cnt_flat, followed by the total number of points.
+		w, h : int
+			Width and height of the image the contours were extracted from.
+		edge_thresh : int
+			Contours with points this close to the frame edge are rejected.
+		min_area, max_area : float, default = 10.0, 2000.0
+			Range of the area of a tag. Tags have a negative (clockwise) signed area.
+
+		Returns
+		-------
+		keep_idx : 1-D numpy array
+			Indices of the contours that pass the filter.
+		areas : 1-D numpy array
+			Signed area of each kept contour, same as cv2.contourArea(cnt, True).
+
+	"""
+	n_contours = offsets.shape[0] - 1
+	keep_idx = np.empty(n_contours, np.int64)
+	areas = np.empty(n_contours, np.float64)
+	n_keep = 0
+
+	maxx_thresh = w - edge_thresh
+	maxy_thresh = h - edge_thresh
+
+	for i in range(n_contours):
+		start = offsets[i]
+		end = offsets[i+1]
+
+		if end - start < 4: # only look at contours that could be tags
+			continue
+
+		area = 0.0
+		on_edge = False
+		prev_x = cnt_flat[end-1, 0]
+		prev_y = cnt_flat[end-1, 1]
+
+		for j in range(start, end):
+			x = cnt_flat[j, 0]
+			y = cnt_flat[j, 1]
+			area += float(prev_x)*y - float(prev_y)*x
+			if x <= edge_thresh or y <= edge_thresh or x >= maxx_thresh or y >= maxy_thresh:
+				on_edge = True
+			prev_x = x
+			prev_y = y
+
+		area *= 0.5
+
+		if -min_area > area > -max_area and not on_edge: # check area and distance to the edge
+			keep_idx[n_keep] = i
+			areas[n_keep] = area
+			n_keep += 1
+
+	return keep_idx[:n_keep], areas[:n_keep]
+
+@njit(cache = True, fastmath = True)
+def quad_props(p):
+
+	""" Returns the perimeter, signed area and convexity of a quadrilateral.
+
+		Same results as cv2.arcLength(p, True), cv2.contourArea(p, True) and
+		cv2.isContourConvex(p), computed in a single pass.
+
+		Parameters
+		----------
+		p : (4x2) numpy array
+			Corners of the quadrilateral in order.
+
+		Returns
+		-------
+		peri : float
+			Perimeter of the closed polygon.
+		area : float
+			Signed area, negative for clockwise corners in image coordinates.
+		convex : bool
+			True if all turns have the same, non-zero direction.
+
+	"""
+	peri = 0.0
+	area = 0.0
+	n_pos = 0
+	n_neg = 0
+
+	for i in range(4):
+		j = (i+1) % 4
+		k = (i+2) % 4
+		dx = float(p[j,0] - p[i,0])
+		dy = float(p[j,1] - p[i,1])
+		peri += math.hypot(dx, dy)
+		area += float(p[i,0])*p[j,1] - float(p[j,0])*p[i,1]
+
+		# convexity via cross-product sign consistency
+		cross = dx*(p[k,1] - p[j,1]) - dy*(p[k,0] - p[j,0])
+		if cross > 0:
+			n_pos += 1
+		elif cross < 0:
+			n_neg += 1
+
+	convex = n_pos == 4 or n_neg == 4
+
+	return peri, area*0.5, convex
+
+def read_frames(cap, frame_queue, stop):
+
+    """ Reads frames from cap into frame_queue until the video ends or stop is set.
+
+        Each item is (image, msec, frame_number). None is put on the queue when reading stops.
+    """
 
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
 
+    try:
+        while cap.isOpened() and not stop.is_set():
 
-def decode(working_dir, working_file):
+            ret, image = cap.read()
+
+            if ret:
+                frame_queue.put((image, cap.get(cv2.CAP_PROP_POS_MSEC), cap.get(cv2.CAP_PROP_POS_FRAMES)))
+            elif cap.get(cv2.CAP_PROP_POS_FRAMES) == frame_count:
+                break
+    finally:
+        # the consumer waits for None, so send it even if reading failed
+        frame_queue.put(None)
+
+def write_frames(out, write_queue, errors):
+
+    """ Writes frames from write_queue to out until None is received.
+
+        If writing fails the exception is appended to errors and the remaining
+        frames are taken off the queue unwritten, so the producer never blocks.
+    """
+
+    while True:
+
+        image = write_queue.get()
+
+        if image is None:
+            break
+
+        if not errors:
+            try:
+                out.write(image)
+            except Exception as e:
+                errors.append(e)
+
+
+
+
+def decode(working_dir, working_file, calib_file = None, debug = False, write_video = True, use_gpu = False, skip_static = False):
 
 
 
@@ -366,9 +635,9 @@ def decode(working_dir, working_file):
 
     # In[ ]:
 
-    ##
-    ##calib_params = load_calib("gopro_calibration.pkl")
-    ##calib_params
+    # pass calib_file = "gopro_calibration.pkl" to undistort frames
+    if calib_file is not None:
+        calib_params = load_calib(calib_file)
 
 
     # ## Add borders back to barcodes
@@ -377,20 +646,28 @@ def decode(working_dir, working_file):
 
 
     barcode_size = (7,7)
-    barcodes = []
-    for barcode in master_list:
-        tag_shape, barcode = add_border(barcode, (5,5), white_width = 1, black_width = 0)
-        barcode = barcode.reshape(tag_shape)
-        barcode = cv2.resize(barcode, barcode_size, interpolation = cv2.INTER_AREA)
-        barcode = barcode.flatten()
-        barcodes.append(barcode)
-    barcodes = np.array(barcodes)
-    barcodes
+    # a 1 pixel white border (no black border) brings the 5x5 tags to barcode_size,
+    # so the whole list is padded at once and needs no resizing
+    barcodes = np.array(master_list, dtype = np.float32).reshape((-1,5,5))
+    barcodes = np.pad(barcodes, ((0,0),(1,1),(1,1)), 'constant', constant_values = 1.0)
+    barcodes = barcodes.reshape((-1, barcode_size[0]*barcode_size[1]))
+
+    # normalize the barcodes once, rather than for every tag
+    barcodes_unit = barcodes - barcodes.mean(1, keepdims = True)
+    barcodes_unit /= np.sqrt(np.square(barcodes_unit).sum(1, keepdims = True))
+    barcode_hashes = hash_tags(barcodes > 0.5)
 
     # open video file
     video_input_dir = working_dir
     video_input_filename =  working_file + ".MP4"
-    cap = cv2.VideoCapture(video_input_dir + video_input_filename) 
+    video_input_path = os.path.join(video_input_dir, video_input_filename)
+    # use hardware decoding when this OpenCV build supports it (OpenCV >= 4.5.2)
+    hw_accel = hasattr(cv2, 'CAP_PROP_HW_ACCELERATION')
+    if hw_accel:
+        cap = cv2.VideoCapture(video_input_path, cv2.CAP_FFMPEG,
+                               [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    else:
+        cap = cv2.VideoCapture(video_input_path)
     print "Is video opening properly?", cap.isOpened()
 
     # set starting position either by frame number or timestamp in ms
@@ -401,28 +678,48 @@ def decode(working_dir, working_file):
     data_dir = working_dir # set location for data output
     data_dir_csv = '/home/gustavo/Cockatiels/CSV/'
     data_filename = working_file + '_output.csv' # set data filename
-    savefile = open(data_dir_csv + data_filename, "w+") # open data file in write mode
+    savefile = open(os.path.join(data_dir_csv, data_filename), "w+", 1 << 20) # open data file in write mode with a 1 MB buffer
 
     # write column names to file
     write_str = "msec" + "," + "frame_number" + "," + "id" + "," + "id_prob" + "," + "x" + "," + "y" + "," + "orientation" + "\n"
     savefile.write(write_str)
 
+    # buffer detections as numeric rows and write them with np.savetxt in chunks
+    rows = np.empty((10000, 7), np.float64)
+    n_rows = 0
+    row_fmt = "%.3f,%d,%d,%.4f,%.2f,%.2f,%.2f"
+
     #set cropped area, default is full frame
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) #frame width as integer
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))#frame height as integer
     pt1 = (0,0) #top-left corner
     pt2 = (frame_width,frame_height) #bottom-right corner
     #pt2 = (1920,1080) #bottom-right corner
-
-    # Define the codec and create VideoWriter object
-    video_out_dir = working_dir
-    video_out_filename = working_file + '_output.mp4'
-    video_out_fps = 24.0
-    video_out_size = (frame_width, frame_height) # (width, height)
-    video_out_color = True
-    fourcc = 0x00000021 #cv2.VideoWriter_fourcc('A','V','C','1') # set codec
-    out = cv2.VideoWriter(video_out_dir + video_out_filename, fourcc, video_out_fps, video_out_size, video_out_color)
-    out.set(cv2.VIDEOWRITER_PROP_QUALITY, 100) # max quality
+    crop_width = pt2[0] - pt1[0] # size of the cropped area, all per-frame images use it
+    crop_height = pt2[1] - pt1[1]
+
+    # build undistortion maps once, only cv2.remap() runs per frame
+    if calib_file is not None:
+        map1, map2, roi = build_undistort_maps(calib_params, (frame_width, frame_height))
+
+    # Define the codec and create VideoWriter object, set write_video = False to only save the data
+    if write_video:
+        video_out_dir = working_dir
+        video_out_filename = working_file + '_output.mp4'
+        video_out_path = os.path.join(video_out_dir, video_out_filename)
+        video_out_fps = 24.0
+        video_out_size = (crop_width, crop_height) # (width, height)
+        if debug:
+            video_out_size = (crop_width, crop_height*2) # threshold image is stacked below the output
+        video_out_color = True
+        fourcc = 0x00000021 #cv2.VideoWriter_fourcc('A','V','C','1') # set codec
+        if hw_accel:
+            out = cv2.VideoWriter(video_out_path, cv2.CAP_FFMPEG, fourcc, video_out_fps, video_out_size,
+                                  [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+                                   cv2.VIDEOWRITER_PROP_IS_COLOR, int(video_out_color)])
+        else:
+            out = cv2.VideoWriter(video_out_path, fourcc, video_out_fps, video_out_size, video_out_color)
+        out.set(cv2.VIDEOWRITER_PROP_QUALITY, 100) # max quality
 
     font = cv2.FONT_HERSHEY_SIMPLEX # set font
 
@@ -443,169 +740,320 @@ def decode(working_dir, working_file):
     # In[ ]:
 
 
-    while cap.isOpened():  
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+
+    # always stop the threads, even if tracking or its setup fails, so they can't block forever
+    reader = None
+    writer = None
+    writer_errors = []
+    frame = ()
+    try:
+        # decode and encode video in their own threads so they overlap with tracking
+        frame_queue = queue.Queue(maxsize = 4)
+        write_queue = queue.Queue(maxsize = 4)
+        stop_reading = threading.Event()
+        reader = threading.Thread(target = read_frames, args = (cap, frame_queue, stop_reading))
+        reader.start()
+        if write_video:
+            writer = threading.Thread(target = write_frames, args = (out, write_queue, writer_errors))
+            writer.start()
+
+        # preallocate the per-frame images; frames passed to the writer rotate
+        # through enough buffers that it never reads one that is being filled
+        n_buffers = write_queue.maxsize + 2
+        buffer_idx = 0
+        if write_video:
+            display_imgs = [np.empty((crop_height, crop_width, 3), np.uint8) for i in range(n_buffers)]
+        if write_video and debug:
+            mosaics = [np.empty((crop_height*2, crop_width, 3), np.uint8) for i in range(n_buffers)]
+        gray = np.empty((crop_height, crop_width), np.uint8)
+        small = np.empty(((crop_height+1)//2, (crop_width+1)//2), np.uint8)
+        thresh = np.empty(small.shape, np.uint8)
+        if write_video and debug:
+            thresh_full = np.empty((crop_height, crop_width), np.uint8)
+        warped = np.empty((maxSide, maxSide), np.uint8)
+        resize_warp = np.empty(barcode_size, np.uint8)
+
+        # warp tags on the GPU when requested and OpenCV was built with CUDA,
+        # the frame is uploaded once and the resized tags are stacked in g_tags,
+        # one tag every barcode_size[1] rows, and downloaded together
+        use_gpu = use_gpu and cv2.cuda.getCudaEnabledDeviceCount() > 0
+        if use_gpu:
+            gpu_batch = 256 # tags held on the GPU before they have to be downloaded
+            g_gray = cv2.cuda_GpuMat()
+            g_warped = cv2.cuda_GpuMat(maxSide, maxSide, cv2.CV_8UC1)
+            g_tags = cv2.cuda_GpuMat(gpu_batch*barcode_size[1], barcode_size[0], cv2.CV_8UC1)
+
+        # with skip_static, frames where no pixel differs from the last tracked
+        # frame by more than static_delta reuse its detections instead of being
+        # tracked again; the test is per pixel so a single moving tag is caught
+        static_delta = 2
+        if skip_static:
+            diff = np.empty((crop_height, crop_width), np.uint8)
+
+        # contours are found on a half resolution copy of the frame (cv2.pyrDown),
+        # so the size limits for tags are scaled down to match
+        contour_scale = 2
+        min_area = 10.0/contour_scale**2
+        max_area = 2000.0/contour_scale**2
+        max_peri = 500.0/contour_scale
+        min_periarea = -0.5*contour_scale
+        prev_gray = None
+        prev_results = ([], [])
+
+        while True:  
         
-        ret, image = cap.read()
+            frame = frame_queue.get()
+
+            if frame is None:
+                break
+
+            image, msec, frame_no = frame
         
-        if ret:
-            n_tags = 0
-            
-            #image = undistort_image(image, calib_params, crop = False)
+            if calib_file is not None:
+                image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
             image = crop(image, pt1, pt2)        
-            display_img = image.copy()
-            gray = get_grayscale(image, channel = 'green')
-            gray = cv2.GaussianBlur(gray, (1,1), 1)
-            thresh = get_threshold(gray, block_size = 201, offset = 0)
-            #thresh = get_threshold(gray, block_size = 201, offset = -20)
-            contours = get_contours(thresh)
-            
-            # define frame edges for checking for tags
-            edge_thresh = 1
-            image_shape = image.shape
-            maxx_thresh = image_shape[1] - edge_thresh
-            maxy_thresh = image_shape[0] - edge_thresh
-            
-            for cnt in contours:
-                
-                cnt_shape = cnt.shape
-
-                if cnt_shape[0] >= 4: # only look at contours that could be tags
-                    
-                    area = cv2.contourArea(cnt, True)
-
-                    if -10 > area > -2000: # check area
-                        
-                        # check for contours too close to the edge to read
-                        cnt_reshape = cnt.reshape((cnt_shape[0], cnt_shape[2]))
-                        cnt_x = cnt_reshape[:,0]
-                        cnt_y = cnt_reshape[:,1]#COCKATIELS
-                        flat = cnt.flatten()
-                        edge_zero = np.sum(flat <= edge_thresh)
-                        edge_maxx = np.sum(cnt_x >= maxx_thresh)
-                        edge_maxy = np.sum(cnt_y >= maxy_thresh)
-
-                        if edge_zero == 0 and edge_maxx == 0 and edge_maxy == 0:
-                            
-                            # fit a polygon 
-                            
-                            peri_cnt = cv2.arcLength(cnt, True)
-
-                            #approx = cv2.approxPolyDP(cnt, 0.1 * peri_cnt, True)
-                            approx = cv2.approxPolyDP(cnt, 0.07 * peri_cnt, True)
-                            
-                            #cv2.drawContours(display_img, [approx], -1, (127,0,255), 3)
-
-                            poly_area = cv2.contourArea(approx, True)
-                            
-                            # check if it's approximately a parallelogram
-                            if len(approx) == 4 and -10 > poly_area > -2000 and cv2.isContourConvex(approx) and 0 < peri_cnt < 500:
-                                peri_approx = cv2.arcLength(approx, True)
-
-                                periarea = peri_cnt/area
-                                
-                                #cv2.drawContours(display_img, [cnt], -1, (0,0,255), 2)
-                                
-                                # check that the geometry isn't too complex
-                                if -0.5 < periarea <= 0:
-                                
-                                    cv2.drawContours(display_img, [cnt], -1, (0,255,255), 1)
-
-                                    cnt_shape = approx.shape
-                                    pts = approx.reshape((cnt_shape[0], cnt_shape[-1]))
-
-                                    # get the corners of the parallelogram
-                                    pts = order_points(pts)
-                                    (tl, tr, br, bl) = pts
-                                                                    
-                                    # compute the perspective transform matrix and then apply it
-                                    M = cv2.getPerspectiveTransform(pts, dst)
-                                    warped = cv2.warpPerspective(gray, M, (maxSide, maxSide), borderValue = 255 )
-                                    resize_warp = cv2.resize(warped, barcode_size, interpolation = cv2.INTER_AREA)
-                                    
-                                    # calculate best match with master_list
-                                    correlation = corr2_coeff(barcodes, resize_warp.reshape((1,flat_len)))
-                                    best_value = np.max(correlation)
-                                    
-                                    if best_value > 0.8: #check for prob of match
-                                        
-                                        best_index = np.argmax(correlation)
-
-                                        ID = IDs[best_index]
-                                        centroid = np.array(pts.mean(0))
-                                        y_offset = 0
-                                        x_offset = 0
-                                        bottom_centroid = tuple((centroid + np.array([x_offset,-1*y_offset])).astype(int))
-                                        top_centroid = tuple((centroid + np.array([x_offset,y_offset])).astype(int))
-                                        mid_centroid = tuple((centroid + np.array([x_offset,0])).astype(int))
-                                        rotate_test = best_index % 4
-
-                                        if rotate_test == 3:
-                                            edge = np.array(np.mean([tl, tr], axis = 0))
-                                        if rotate_test == 0:
-                                            edge = np.array(np.mean([tl, bl], axis = 0))
-                                        if rotate_test == 1:
-                                            edge = np.array(np.mean([br, bl], axis = 0))
-                                        if rotate_test == 2:
-                                            edge = np.array(np.mean([br, tr], axis = 0))
-                                        
-                                        cv2.drawContours(display_img, [approx], -1, (0,255,0), 1)
-
-                                        edge[1] = -edge[1]
-                                        centroid[1] = -centroid[1]
-                                        vector = np.subtract(edge, centroid)
-                                        vector_angle = angle(vector)
-                                        #angle_list.append(vector_angle)
-                                        angle_str = '%.0f' % vector_angle
-                                        bestval_str = '%.2f' % best_value
-                                        
-                                        cv2.arrowedLine(display_img, tuple(centroid), tuple(edge), (0,0,255), 1, tipLength = 0.5)
-
-                                        font_scale = 1.5
-                                        outline_font = 5
-                                        inline_font = 2
-
-                                        cv2.putText(display_img,str(ID),mid_centroid, font, font_scale,(0,0,0),outline_font,cv2.LINE_AA)
-                                        cv2.putText(display_img,str(ID),mid_centroid, font, font_scale,(255,255,255),inline_font,cv2.LINE_AA)
-
-                                        #cv2.putText(display_img,"ID: " + str(ID),top_centroid, font, font_scale,(0,0,0),outline_font,cv2.LINE_AA)
-                                        #cv2.putText(display_img,"ID: " + str(ID),top_centroid, font, font_scale,(255,255,255),inline_font,cv2.LINE_AA)
-
-                                        #cv2.putText(display_img,"O: " + angle_str, mid_centroid, font, font_scale, (0,0,0),outline_font,cv2.LINE_AA)
-                                        #cv2.putText(display_img,"O: " + angle_str, mid_centroid, font, font_scale, (255,255,255),inline_font,cv2.LINE_AA)
-
-                                        #cv2.putText(display_img,"C: " + bestval_str, bottom_centroid, font, font_scale, (0,0,0),outline_font,cv2.LINE_AA)
-                                        #cv2.putText(display_img,"C: " + bestval_str, bottom_centroid, font, font_scale, (255,255,255),inline_font,cv2.LINE_AA)
-
-                                        n_tags += 1
-                                        
-                                        #write to data file
-                                        write_str = str(cap.get(cv2.CAP_PROP_POS_MSEC)) + "," + str(cap.get(cv2.CAP_PROP_POS_FRAMES)) + "," + str(ID) + "," + str(best_value) + "," + str(centroid[0]+pt1[0]) + "," + str(centroid[1]+pt1[1]) + "," + str(vector_angle) + "\n"
-                                        savefile.write(write_str)
-                                        
-            cv2.putText(display_img,"Number of Barcodes: " + str(n_tags),(30,50), font, 1,(0,0,0),15,cv2.LINE_AA)
-            cv2.putText(display_img,"Number of Barcodes: " + str(n_tags),(30,50), font, 1,(255,255,255),3,cv2.LINE_AA)
+            if write_video:
+                display_img = display_imgs[buffer_idx]
+                np.copyto(display_img, image)
+            # copy the channel view into a contiguous buffer once, otherwise
+            # OpenCV copies the whole frame again for every warped tag
+            np.copyto(gray, get_grayscale(image, channel = 'green'))
+
+            # reuse the last detections while the frame hasn't changed since it was tracked
+            if prev_gray is not None and cv2.minMaxLoc(cv2.absdiff(gray, prev_gray, dst = diff))[1] <= static_delta:
+                tag_cnts, detections = prev_results
+            else:
+                cv2.pyrDown(gray, dst = small)
+                get_threshold(small, block_size = 101, offset = 0, dst = thresh)
+                #thresh = get_threshold(small, block_size = 101, offset = -20)
+                contours = get_contours(thresh)
+        
+                # define frame edges for checking for tags
+                edge_thresh = 1
+                image_shape = small.shape
+                maxx_thresh = image_shape[1] - edge_thresh
+                maxy_thresh = image_shape[0] - edge_thresh
+        
+                # candidate tags for this frame, matched together after the contour loop
+                tag_cnts = []
+                candidates = []
+                warps = []
+                gray_uploaded = False
+                n_gpu_tags = 0
+
+                # drop contours that can't be tags before fitting polygons, first
+                # by their length and bounding box, then by their area
+                keep_idx, areas = [], []
+                if len(contours) > 0:
+                    lens = np.array([len(c) for c in contours], np.int32)
+                    bboxes = np.array([cv2.boundingRect(c) for c in contours], np.int32)
+                    survivors = np.flatnonzero((lens >= 4) &
+                                               (bboxes[:,0] > edge_thresh) & (bboxes[:,1] > edge_thresh) &
+                                               (bboxes[:,0] + bboxes[:,2] <= maxx_thresh) &
+                                               (bboxes[:,1] + bboxes[:,3] <= maxy_thresh))
+
+                    if len(survivors) > 0:
+                        offsets = np.zeros(len(survivors) + 1, np.int64)
+                        np.cumsum(lens[survivors], out = offsets[1:])
+                        cnt_flat = np.concatenate([contours[i].reshape(-1,2) for i in survivors])
+                        keep_idx, areas = prefilter(cnt_flat, offsets, image_shape[1], image_shape[0], edge_thresh, min_area, max_area)
+                        keep_idx = survivors[keep_idx]
+
+                for cnt_idx, area in zip(keep_idx, areas):
+
+                    cnt = contours[cnt_idx]
+
+                    # fit a polygon 
             
-            thresh = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)
-            #display_img = np.concatenate((display_img))
-            out.write(display_img)
+                    peri_cnt = cv2.arcLength(cnt, True)
+
+                    #approx = cv2.approxPolyDP(cnt, 0.1 * peri_cnt, True)
+                    approx = cv2.approxPolyDP(cnt, 0.07 * peri_cnt, True)
             
+                    #cv2.drawContours(display_img, [approx], -1, (127,0,255), 3)
+
+                    if len(approx) == 4:
+                        peri_approx, poly_area, convex = quad_props(approx.reshape((4,2)))
+                    else:
+                        poly_area, convex = 0.0, False
             
+                    # check if it's approximately a parallelogram
+                    if -min_area > poly_area > -max_area and convex and 0 < peri_cnt < max_peri:
+                        periarea = peri_cnt/area
+                
+                        #cv2.drawContours(display_img, [cnt], -1, (0,0,255), 2)
+                
+                        # check that the geometry isn't too complex
+                        if min_periarea < periarea <= 0:
+                
+                            # scale back up to the full resolution frame
+                            tag_cnts.append(cnt*contour_scale)
+                            approx = approx*contour_scale
+
+                            cnt_shape = approx.shape
+                            pts = approx.reshape((cnt_shape[0], cnt_shape[-1]))
+
+                            # get the corners of the parallelogram
+                            pts = order_points(pts)
+                                                    
+                            # compute the perspective transform matrix and then apply it
+                            M = cv2.getPerspectiveTransform(pts, dst)
+                            if use_gpu:
+                                if not gray_uploaded:
+                                    g_gray.upload(gray)
+                                    gray_uploaded = True
+                                if n_gpu_tags == gpu_batch:
+                                    warps.extend(g_tags.download().reshape((gpu_batch, flat_len)))
+                                    n_gpu_tags = 0
+                                g_tag = g_tags.rowRange(n_gpu_tags*barcode_size[1], (n_gpu_tags+1)*barcode_size[1])
+                                cv2.cuda.warpPerspective(g_gray, M, (maxSide, maxSide), dst = g_warped, borderValue = 255 )
+                                cv2.cuda.resize(g_warped, barcode_size, dst = g_tag, interpolation = cv2.INTER_AREA)
+                                n_gpu_tags += 1
+                            else:
+                                cv2.warpPerspective(gray, M, (maxSide, maxSide), dst = warped, borderValue = 255 )
+                                cv2.resize(warped, barcode_size, dst = resize_warp, interpolation = cv2.INTER_AREA)
+                                warps.append(resize_warp.flatten()) # copy, resize_warp is reused
+
+                            candidates.append((approx, pts))
+
+                # fetch the tags still on the GPU with a single download
+                if n_gpu_tags > 0:
+                    g_tag = g_tags.rowRange(0, n_gpu_tags*barcode_size[1])
+                    warps.extend(g_tag.download().reshape((n_gpu_tags, flat_len)))
+
+                # calculate best match with master_list for all candidates at once
+                detections = []
+                if len(warps) > 0:
+                    best_indices, best_values = match_tags(warps, barcodes_unit, barcode_hashes)
+
+                for i, (approx, pts) in enumerate(candidates):
+
+                    best_index = best_indices[i]
+                    best_value = best_values[i]
+
+                    if best_value > 0.8: #check for prob of match
+
+                        (tl, tr, br, bl) = pts
+                        ID = IDs[best_index]
+                        centroid = np.array(pts.mean(0))
+                        y_offset = 0
+                        x_offset = 0
+                        bottom_centroid = tuple((centroid + np.array([x_offset,-1*y_offset])).astype(int))
+                        top_centroid = tuple((centroid + np.array([x_offset,y_offset])).astype(int))
+                        mid_centroid = tuple((centroid + np.array([x_offset,0])).astype(int))
+                        rotate_test = best_index % 4
+
+                        if rotate_test == 3:
+                            edge = np.array(np.mean([tl, tr], axis = 0))
+                        if rotate_test == 0:
+                            edge = np.array(np.mean([tl, bl], axis = 0))
+                        if rotate_test == 1:
+                            edge = np.array(np.mean([br, bl], axis = 0))
+                        if rotate_test == 2:
+                            edge = np.array(np.mean([br, tr], axis = 0))
+
+                        edge[1] = -edge[1]
+                        centroid[1] = -centroid[1]
+                        vector = np.subtract(edge, centroid)
+                        vector_angle = angle(vector)
+                        #angle_list.append(vector_angle)
+
+                        detections.append((approx, centroid, edge, mid_centroid, ID, best_value, vector_angle))
+
+                if skip_static:
+                    prev_results = (tag_cnts, detections)
+                    if prev_gray is None:
+                        prev_gray = gray.copy()
+                    else:
+                        np.copyto(prev_gray, gray)
+
+            if write_video:
+                cv2.drawContours(display_img, tag_cnts, -1, (0,255,255), 1)
+
+            for (approx, centroid, edge, mid_centroid, ID, best_value, vector_angle) in detections:
+
+                if write_video:
+                    cv2.drawContours(display_img, [approx], -1, (0,255,0), 1)
+
+                    angle_str = '%.0f' % vector_angle
+                    bestval_str = '%.2f' % best_value
+
+                    cv2.arrowedLine(display_img, tuple(centroid), tuple(edge), (0,0,255), 1, tipLength = 0.5)
+
+                    font_scale = 1.5
+                    outline_font = 5
+                    inline_font = 2
+
+                    cv2.putText(display_img,str(ID),mid_centroid, font, font_scale,(0,0,0),outline_font,cv2.LINE_AA)
+                    cv2.putText(display_img,str(ID),mid_centroid, font, font_scale,(255,255,255),inline_font,cv2.LINE_AA)
+
+                    #cv2.putText(display_img,"ID: " + str(ID),top_centroid, font, font_scale,(0,0,0),outline_font,cv2.LINE_AA)
+                    #cv2.putText(display_img,"ID: " + str(ID),top_centroid, font, font_scale,(255,255,255),inline_font,cv2.LINE_AA)
+
+                    #cv2.putText(display_img,"O: " + angle_str, mid_centroid, font, font_scale, (0,0,0),outline_font,cv2.LINE_AA)
+                    #cv2.putText(display_img,"O: " + angle_str, mid_centroid, font, font_scale, (255,255,255),inline_font,cv2.LINE_AA)
+
+                    #cv2.putText(display_img,"C: " + bestval_str, bottom_centroid, font, font_scale, (0,0,0),outline_font,cv2.LINE_AA)
+                    #cv2.putText(display_img,"C: " + bestval_str, bottom_centroid, font, font_scale, (255,255,255),inline_font,cv2.LINE_AA)
+
+                #write to data file
+                if n_rows == len(rows):
+                    np.savetxt(savefile, rows, fmt = row_fmt)
+                    n_rows = 0
+                rows[n_rows] = (msec, frame_no, ID, best_value, centroid[0]+pt1[0], centroid[1]+pt1[1], vector_angle)
+                n_rows += 1
+
+            if write_video:
+                n_tags = len(detections)
+                cv2.putText(display_img,"Number of Barcodes: " + str(n_tags),(30,50), font, 1,(0,0,0),15,cv2.LINE_AA)
+                cv2.putText(display_img,"Number of Barcodes: " + str(n_tags),(30,50), font, 1,(255,255,255),3,cv2.LINE_AA)
+        
+                if debug:
+                    mosaic = mosaics[buffer_idx]
+                    np.copyto(mosaic[:crop_height], display_img)
+                    cv2.resize(thresh, (crop_width, crop_height), dst = thresh_full, interpolation = cv2.INTER_NEAREST)
+                    cv2.cvtColor(thresh_full, cv2.COLOR_GRAY2BGR, dst = mosaic[crop_height:])
+                    write_queue.put(mosaic)
+                else:
+                    write_queue.put(display_img)
+                buffer_idx = (buffer_idx + 1) % n_buffers
+        
+        
             #cv2.imshow('Video', display_img) #this is for displaying the tracking
-                    
-            if cap.get(cv2.CAP_PROP_POS_FRAMES) % 10 == 0: # set number of frames to report percent complete
-                print 'percent finished: %.5f' % (float(cap.get(cv2.CAP_PROP_POS_FRAMES))/float(cap.get(cv2.CAP_PROP_FRAME_COUNT))*100.0)
+                
+            if frame_no % 10 == 0: # set number of frames to report percent complete
+                print 'percent finished: %.5f' % (float(frame_no)/float(frame_count)*100.0)
 
-        elif cap.get(cv2.CAP_PROP_POS_FRAMES) == cap.get(cv2.CAP_PROP_FRAME_COUNT):
-            break
-        if cv2.waitKey(1) & 0xFF == 27:
-            break
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
             
 
+    finally:
+        # stop the reader and wait for the writer to finish
+        if reader is not None:
+            stop_reading.set()
+            while frame is not None:
+                frame = frame_queue.get()
+            reader.join()
+        if writer is not None:
+            write_queue.put(None)
+            writer.join()
+        if write_video:
+            out.release()
+        # save the buffered detections even if tracking failed
+        try:
+            np.savetxt(savefile, rows[:n_rows], fmt = row_fmt)
+        finally:
+            savefile.close()
+
     # clean up when finished
     cap.release()
-    out.release()
     cv2.destroyAllWindows()
-    savefile.close()
+
+    # report a failure of the video writer once the data is saved
+    if writer_errors:
+        raise writer_errors[0]
 
     for i in range(5):
         cv2.waitKey(1)